@@ -5,10 +5,8 @@
 __author__ = 'Konstantin Ryabitsev <konstantin@linuxfoundation.org>'
 
 import sys
-import sqlite3
 
 import wotmate
-import pydotplus.graphviz as pd
 
 
 if __name__ == '__main__':
@@ -49,8 +47,13 @@ if __name__ == '__main__':
         logger.critical('Please provide a single key id for path tracing')
         sys.exit(1)
 
-    dbconn = sqlite3.connect(cmdargs.dbfile)
+    dbconn = wotmate.open_db_ro(cmdargs.dbfile)
     cursor = dbconn.cursor()
+    # We mostly read the whole sig table in one go, so keep it in memory
+    cursor.executescript('''PRAGMA cache_size=-65536;
+                            PRAGMA mmap_size=1073741824;
+                            PRAGMA temp_store=MEMORY;
+                         ''')
 
     if not cmdargs.fromkey:
         from_rowid = wotmate.get_u_key(cursor)
@@ -66,19 +69,15 @@ if __name__ == '__main__':
     if to_rowid is None:
         sys.exit(1)
 
+    # Fetch all signatures with one query and walk them in memory, which
+    # is a lot cheaper than having sqlite expand every key on the way
+    wotmate.load_sig_graph(cursor)
     key_paths = wotmate.get_key_paths(cursor, from_rowid, to_rowid, cmdargs.maxdepth, cmdargs.maxpaths)
 
-    graph = pd.Dot(
-        graph_type='digraph',
-    )
-    graph.set_node_defaults(
-        fontname=cmdargs.font,
-        fontsize=cmdargs.fontsize,
-    )
-
-    wotmate.draw_key_paths(cursor, key_paths, graph, cmdargs.show_trust)
+    dotsrc = wotmate.draw_key_paths(cursor, key_paths, cmdargs.font, cmdargs.fontsize, cmdargs.show_trust)
 
     chunks = cmdargs.out.split('.')
     outformat = chunks[-1]
-    graph.write(cmdargs.out, format=outformat)
+    if not wotmate.write_graph(dotsrc, cmdargs.out, outformat):
+        sys.exit(1)
     logger.info('Wrote %s' % cmdargs.out)
@@ -5,13 +5,47 @@
 __author__ = 'Konstantin Ryabitsev <konstantin@linuxfoundation.org>'
 
 import sys
-import sqlite3
+import os
+import itertools
+import logging
 
 import wotmate
-import pydotplus.graphviz as pd
 
 
-def get_key_paths(c, b_p_rowid, maxdepth=5):
+# per-worker state, set up by init_worker
+wc = None
+w_b_p_rowid = None
+w_maxdepth = None
+w_ignorekeys = None
+
+
+def init_worker(dbfile, b_p_rowid, maxdepth, ignorekeys):
+    global wc, w_b_p_rowid, w_maxdepth, w_ignorekeys
+    dbconn = wotmate.open_db_ro(dbfile)
+    wc = dbconn.cursor()
+    w_b_p_rowid = b_p_rowid
+    w_maxdepth = maxdepth
+    w_ignorekeys = ignorekeys
+    # Forked workers inherit the signature graph from the parent, spawned
+    # ones have to load it themselves
+    if not wotmate.have_sig_graph():
+        wotmate.load_sig_graph(wc)
+
+
+def get_candidate_path(f_p_rowid):
+    return wotmate.get_shortest_path(wc, f_p_rowid, w_b_p_rowid, w_maxdepth, w_ignorekeys)
+
+
+def get_candidate_paths(dbfile, f_p_rowids, b_p_rowid, maxdepth, ignorekeys, jobs):
+    # Only pay for importing the process pool machinery when we use it
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(dbfile, b_p_rowid, maxdepth, ignorekeys)) as ex:
+        chunksize = max(1, len(f_p_rowids) // (jobs * 4))
+        return dict(zip(f_p_rowids, ex.map(get_candidate_path, f_p_rowids, chunksize=chunksize)))
+
+
+def get_key_paths(c, b_p_rowid, maxdepth=5, dbfile=None, jobs=1):
     # Next, get rowids of all keys with full trust
     f_p_rowids = wotmate.get_all_full_trust(c)
 
@@ -20,33 +54,54 @@ def get_key_paths(c, b_p_rowid, maxdepth=5):
         sys.exit(1)
 
     paths = []
-    ignorekeys = [item for sublist in f_p_rowids for item in sublist]
+    ignorekeys = set(itertools.chain.from_iterable(f_p_rowids))
     lookedat = 0
 
     logger.info('Found %s fully trusted keys in the db' % len(f_p_rowids))
+
+    # Each search only depends on the ones before it through the keys their
+    # paths went through, which we don't want to reuse. So look everything
+    # up in parallel first, and later redo only the searches that went
+    # through such a key. The rest would have found the same path anyway.
+    candidates = dict()
+    if jobs > 1 and dbfile is not None:
+        candidates = get_candidate_paths(dbfile, [x for (x,) in f_p_rowids], b_p_rowid, maxdepth-1,
+                                         frozenset(ignorekeys), jobs)
+    usedkeys = set()
+    # last hops of the paths we kept, see wotmate.cull_redundant_paths
+    lasthops = set()
+
     for (f_p_rowid,) in f_p_rowids:
         lookedat += 1
-        logger.info('Trying "%s" (%s/%s)' %
-                    (wotmate.get_uiddata_by_pubrow(c, f_p_rowid), lookedat, len(f_p_rowids)))
+        # don't look up the uid just to have it thrown away with --quiet
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Trying "%s" (%s/%s)',
+                        wotmate.get_uiddata_by_pubrow(c, f_p_rowid), lookedat, len(f_p_rowids))
 
-        path = wotmate.get_shortest_path(c, f_p_rowid, b_p_rowid, 0, maxdepth-1, ignorekeys)
+        path = candidates.get(f_p_rowid)
+        if f_p_rowid not in candidates or (path and usedkeys.intersection(path[1:-1])):
+            path = wotmate.get_shortest_path(c, f_p_rowid, b_p_rowid, maxdepth-1, ignorekeys)
 
         if path:
-            logger.info('`- found a path with %s members' % len(path))
-            paths.append(path)
-            # we want to find maximum paths, so we unset _seenkeys
-            wotmate._seenkeys = []
+            logger.info('`- found a path with %s members', len(path))
             if len(path) > 2:
-                ignorekeys += path[1:-1]
+                ignorekeys.update(path[1:-1])
+                usedkeys.update(path[1:-1])
+                # cull redundant paths as we find them
+                lasthop = (path[-2], path[-1])
+                if lasthop in lasthops:
+                    continue
+                lasthops.add(lasthop)
+            paths.append(path)
 
     if not paths:
         logger.critical('No paths found to any fully trusted keys')
         sys.exit(1)
 
-    culled = wotmate.cull_redundant_paths(paths)
-    logger.info('%s paths left after culling' % len(culled))
+    paths.sort(key=len)
+    logger.info('%s paths left after culling' % len(paths))
 
-    return culled
+    return paths
 
 
 if __name__ == '__main__':
@@ -72,6 +127,8 @@ if __name__ == '__main__':
     ap.add_argument('--show-trust', action='store_true', dest='show_trust',
                     default=False,
                     help='Display validity and trust values')
+    ap.add_argument('--jobs', default=os.cpu_count(), type=int,
+                    help='Look for paths from this many trusted keys in parallel')
     ap.add_argument('key_id', nargs=1, default=False,
                     help='Bottom key ID for path tracing')
 
@@ -79,8 +136,13 @@ if __name__ == '__main__':
 
     logger = wotmate.get_logger(cmdargs.quiet)
 
-    dbconn = sqlite3.connect(cmdargs.dbfile)
+    dbconn = wotmate.open_db_ro(cmdargs.dbfile)
     cursor = dbconn.cursor()
+    # We mostly read the whole sig table in one go, so keep it in memory
+    cursor.executescript('''PRAGMA cache_size=-65536;
+                            PRAGMA mmap_size=1073741824;
+                            PRAGMA temp_store=MEMORY;
+                         ''')
 
     if len(cmdargs.key_id) != 1:
         logger.critical('Please provide a single key id for path tracing')
@@ -90,19 +152,16 @@ if __name__ == '__main__':
     if to_rowid is None:
         sys.exit(1)
 
-    key_paths = get_key_paths(cursor, to_rowid, cmdargs.maxdepth)
+    # We look for a path from every fully trusted key, so load the whole
+    # signature graph instead of walking it in sqlite for each of them
+    wotmate.load_sig_graph(cursor)
 
-    graph = pd.Dot(
-        graph_type='digraph',
-    )
-    graph.set_node_defaults(
-        fontname=cmdargs.font,
-        fontsize=cmdargs.fontsize,
-    )
+    key_paths = get_key_paths(cursor, to_rowid, cmdargs.maxdepth, cmdargs.dbfile, cmdargs.jobs)
 
-    wotmate.draw_key_paths(cursor, key_paths, graph, cmdargs.show_trust)
+    dotsrc = wotmate.draw_key_paths(cursor, key_paths, cmdargs.font, cmdargs.fontsize, cmdargs.show_trust)
 
     chunks = cmdargs.out.split('.')
     outformat = chunks[-1]
-    graph.write(cmdargs.out, format=outformat)
+    if not wotmate.write_graph(dotsrc, cmdargs.out, outformat):
+        sys.exit(1)
     logger.info('Wrote %s' % cmdargs.out)
@@ -6,8 +6,35 @@ __author__ = 'Konstantin Ryabitsev <konstantin@linuxfoundation.org>'
 
 import os
 import sqlite3
+import queue
+import threading
 import wotmate
 
+# how many sigs to collect before inserting them, and how many such
+# batches can wait to be inserted while we carry on parsing
+SIG_BATCH_SIZE = 50000
+SIG_WRITE_AHEAD = 4
+
+# gpg gives us timestamps as seconds since epoch, and we store them as
+# local time in isoformat, or '' if there isn't one. Having sqlite do that
+# as it inserts the rows saves us a trip through datetime for every one.
+ISOTIME_SQL = "IFNULL(strftime('%Y-%m-%dT%H:%M:%S', ?, 'unixepoch', 'localtime'), '')"
+PUB_INSERT_SQL = '''INSERT INTO pub (rowid, keyid, validity, size, algo, created, expires, ownertrust)
+                      VALUES (?,?,?,?,?,%s,%s,?)''' % (ISOTIME_SQL, ISOTIME_SQL)
+UID_INSERT_SQL = '''INSERT INTO uid (rowid, pubrowid, validity, created, expires, uiddata, is_primary)
+                      VALUES (?,?,?,%s,%s,?,?)''' % (ISOTIME_SQL, ISOTIME_SQL)
+SIG_INSERT_SQL = 'INSERT INTO sig VALUES (?,?,%s,%s,?)' % (ISOTIME_SQL, ISOTIME_SQL)
+
+# The only sig classes we care about, as gpg lists them: certifications
+# (0x10-0x13) and their revocations (0x30)
+SIG_CLASSES = {b'%02x' % sigtype: sigtype for sigtype in (0x10, 0x11, 0x12, 0x13, 0x30)}
+
+# validity of expired, revoked or otherwise invalid keys and uids
+INVALID_STATES = frozenset((b'e', b'r', b'i'))
+# listing records that start a new uid, and ones that carry sigs
+UID_TAGS = frozenset((b'pub', b'uid'))
+SIG_TAGS = frozenset((b'sig', b'rev'))
+
 
 def keyring_load_pub_uid(c, use_weak):
     logger.info('Loading all valid pubkeys')
@@ -18,52 +45,62 @@ def keyring_load_pub_uid(c, use_weak):
     is_primary = 1
     ignored_keys = 0
     ignored_uids = 0
+    # We assign rowids ourselves, so we can insert everything in one go at
+    # the end instead of a row at a time
+    pub_rows = []
+    uid_rows = []
     for line in wotmate.gpg_get_lines(['--list-public-keys'], [b'pub:', b'uid']):
-        fields = wotmate.gpg_get_fields(line)
-        if fields[0] == 'pub':
+        # Leave everything as bytes and only decode what we store. The
+        # timestamps can stay as they are, since sqlite formats them.
+        fields = line.split(b':')
+        if fields[0] == b'pub':
             # is this key expired/revoked or is otherwise invalid?
-            if fields[1] in ('e', 'r', 'i'):
+            if fields[1] in INVALID_STATES:
                 ignored_keys += 1
                 continue
             # is this key too weak to bother considering it?
-            if not use_weak and (fields[3] in ('1', '17') and int(fields[2]) < 2048):
+            if not use_weak and (fields[3] in (b'1', b'17') and int(fields[2]) < 2048):
                 # logger.info('Ignoring weak key: %s' % fields[4])
                 ignored_keys += 1
                 continue
 
+            current_pubkey = fields[4].decode()
+            current_pubrowid = len(pub_rows) + 1
             data = (
-                    fields[4],
-                    fields[1],
-                    fields[2],
-                    fields[3],
+                    current_pubrowid,
+                    current_pubkey,
+                    fields[1].decode(),
+                    fields[2].decode(),
+                    fields[3].decode(),
                     fields[5],
                     fields[6],
-                    fields[8],
+                    fields[8].decode(),
                    )
-            c.execute('INSERT INTO pub VALUES (?,?,?,?,?,?,?)', data)
-            current_pubkey = fields[4]
-            current_pubrowid = c.lastrowid
+            pub_rows.append(data)
             is_primary = 1
 
-        elif fields[0] == 'uid':
-            if fields[1] in ('e', 'r', 'i'):
+        elif fields[0] == b'uid':
+            if fields[1] in INVALID_STATES:
                 ignored_uids += 1
                 continue
 
             if current_pubrowid is not None:
+                uidrowid = len(uid_rows) + 1
                 data = (
+                    uidrowid,
                     current_pubrowid,
-                    fields[1],
+                    fields[1].decode(),
                     fields[5],
                     fields[6],
-                    fields[9],
+                    # gpg uses \x3a to indicate an encoded colon
+                    fields[9].decode('utf8', 'ignore').replace('\\x3a', ':'),
                     is_primary,
                 )
-                c.execute('INSERT INTO uid VALUES (?,?,?,?,?,?)', data)
-                uid_hash_rowid_map[(current_pubkey, fields[7])] = c.lastrowid
+                uid_rows.append(data)
+                uid_hash_rowid_map[(current_pubkey, fields[7].decode())] = uidrowid
 
                 if is_primary:
-                    pub_keyid_rowid_map[current_pubkey] = (current_pubrowid, c.lastrowid)
+                    pub_keyid_rowid_map[current_pubkey] = (current_pubrowid, uidrowid)
 
                 is_primary = 0
             else:
@@ -71,111 +108,154 @@ def keyring_load_pub_uid(c, use_weak):
         else:
             pass
 
+    c.executemany(PUB_INSERT_SQL, pub_rows)
+    c.executemany(UID_INSERT_SQL, uid_rows)
+
     logger.info('Loaded %s pubkeys (%s ignored)' % (len(pub_keyid_rowid_map), ignored_keys))
     logger.info('Loaded %s uids (%s ignored)' % (len(uid_hash_rowid_map), ignored_uids))
     return pub_keyid_rowid_map, uid_hash_rowid_map
 
 
+def sig_writer(c, batches, errors):
+    # Inserts batches of sig rows until it gets None. If an insert fails,
+    # it keeps taking batches, so the loader never blocks on a full queue.
+    while True:
+        sig_rows = batches.get()
+        if sig_rows is None:
+            break
+        if errors:
+            continue
+        try:
+            c.executemany(SIG_INSERT_SQL, sig_rows)
+        except Exception as ex:
+            errors.append(ex)
+
+
 def keyring_load_sig_data(c, pub_keyid_rowid_map, uid_hash_rowid_map):
     logger.info('Loading signature data')
-    sigquery = 'INSERT INTO sig VALUES (?,?,?,?,?)'
     # used to track the current pubkey/uid
     pubkeyid = None
     uidrowid = None
+    primary_uidrowid = None
     uidsigs = {}
-    revsigs = []
+    revsigs = set()
     is_revuid = False
     sigcount = 0
+    # sigs waiting to be inserted
+    sig_rows = []
     ignored_sigs = 0
 
-    for line in wotmate.gpg_get_lines(['--list-sigs', '--fast-list-mode'],
-                                      [b'pub:', b'uid', b'sig:', b'rev:']):
-
-        fields = wotmate.gpg_get_fields(line)
-
-        if uidsigs and fields[0] in ('pub', 'uid'):
-            c.executemany(sigquery, uidsigs.values())
-            sigcount += len(uidsigs)
-            uidsigs = {}
-            revsigs = []
+    # Insert batches from a separate thread, so sqlite can work on one
+    # while we parse the next. sqlite3 lets go of the GIL while it works.
+    batches = queue.Queue(maxsize=SIG_WRITE_AHEAD)
+    errors = []
+    writer = threading.Thread(target=sig_writer, args=(c.connection.cursor(), batches, errors))
+    writer.start()
+    try:
+        for line in wotmate.gpg_get_lines(['--list-sigs', '--fast-list-mode'],
+                                          [b'pub:', b'uid', b'sig:', b'rev:']):
 
-        if fields[0] == 'pub':
-            uidrowid = None
-            pubkeyid = None
-            is_revuid = False
-            if fields[4] in pub_keyid_rowid_map.keys():
-                pubkeyid = fields[4]
+            # There are a lot of these lines, so only split them up and leave
+            # everything as bytes, except for the few fields we actually need
+            fields = line.split(b':')
 
-        elif fields[0] == 'uid':
-            if not pubkeyid:
-                continue
-            # is this uid expired/revoked or is otherwise invalid?
-            if fields[1] in ('e', 'r', 'i'):
-                is_revuid = True
-                continue
-            try:
-                uidrowid = uid_hash_rowid_map[(pubkeyid, fields[7])]
-            except IndexError:
-                # unknown uid somehow, ignore it
-                continue
+            if fields[0] in UID_TAGS and (uidsigs or revsigs):
+                # drop revoked sigs here instead of chasing them in the loop
+                for sigkeyid, row in uidsigs.items():
+                    if sigkeyid in revsigs:
+                        ignored_sigs += 1
+                    else:
+                        sig_rows.append(row)
+                        sigcount += 1
+                uidsigs = {}
+                revsigs = set()
+                if len(sig_rows) >= SIG_BATCH_SIZE:
+                    if errors:
+                        raise errors[0]
+                    batches.put(sig_rows)
+                    sig_rows = []
+
+            if fields[0] == b'pub':
+                uidrowid = None
+                pubkeyid = None
+                is_revuid = False
+                keyid = fields[4].decode()
+                pubrow = pub_keyid_rowid_map.get(keyid)
+                if pubrow is not None:
+                    pubkeyid = keyid
+                    primary_uidrowid = pubrow[1]
+
+            elif fields[0] == b'uid':
+                if not pubkeyid:
+                    continue
+                # is this uid expired/revoked or is otherwise invalid?
+                if fields[1] in INVALID_STATES:
+                    is_revuid = True
+                    continue
+                try:
+                    uidrowid = uid_hash_rowid_map[(pubkeyid, fields[7].decode())]
+                except KeyError:
+                    # unknown uid somehow, ignore it
+                    continue
 
-        elif fields[0] in ('sig', 'rev'):
-            if not pubkeyid or is_revuid:
-                ignored_sigs += 1
-                continue
-            # some gpg versions, when using --fast-list-mode, don't show UID
-            # entries, so for those cases use the primary UID of the pubkey
-            if uidrowid is None:
-                uidrowid = pub_keyid_rowid_map[pubkeyid][1]
+            elif fields[0] in SIG_TAGS:
+                if not pubkeyid or is_revuid:
+                    ignored_sigs += 1
+                    continue
+                # some gpg versions, when using --fast-list-mode, don't show UID
+                # entries, so for those cases use the primary UID of the pubkey
+                if uidrowid is None:
+                    uidrowid = primary_uidrowid
 
-            sigkeyid = fields[4]
+                sigkeyid = fields[4].decode()
 
-            # ignore self-sigs
-            if sigkeyid == pubkeyid:
-                ignored_sigs += 1
-                continue
+                # ignore self-sigs
+                if sigkeyid == pubkeyid:
+                    ignored_sigs += 1
+                    continue
 
-            # We use this map to eject revoked sigs before we store them
-            # We only want sig types 0x10-13
-            if len(fields[10]) >= 2:
-                sigtype = int(fields[10][:2], base=16)
-                if sigtype == 0x30:
-                    # this is a revsig!
-                    if sigkeyid in uidsigs.keys():
-                        # remove this signature from our sigs to store
-                        del(uidsigs[sigkeyid])
-                        ignored_sigs += 1
-                    # add to revsigs, so we ignore this sig if we see it
-                    revsigs.append(sigkeyid)
+                # Revocations are collected in revsigs and applied at flush time
+                # We only want sig types 0x10-13
+                sigclass = fields[10][:2]
+                if len(sigclass) < 2:
+                    # don't want this sig, as it's not anything we recognize
+                    # for our purposes
                     continue
 
-                elif sigtype < 0x10 or sigtype > 0x13:
+                sigtype = SIG_CLASSES.get(sigclass)
+                if sigtype is None:
                     ignored_sigs += 1
                     continue
 
-            else:
-                # don't want this sig, as it's not anything we recognize
-                # for our purposes
-                continue
+                if sigtype == 0x30:
+                    # this is a revsig! sigs by this key are dropped at flush
+                    revsigs.add(sigkeyid)
+                    continue
 
-            # has this sig been revoked?
+                # do we have the key that signed it?
+                signer = pub_keyid_rowid_map.get(sigkeyid)
+                if signer is not None:
+                    uidsigs[sigkeyid] = (
+                        uidrowid,
+                        signer[0],
+                        fields[5],
+                        fields[6],
+                        sigtype
+                    )
+        # store all sigs seen for previous key+uid
+        for sigkeyid, row in uidsigs.items():
             if sigkeyid in revsigs:
                 ignored_sigs += 1
-                continue
-
-            # do we have the key that signed it?
-            if sigkeyid in pub_keyid_rowid_map.keys():
-                uidsigs[sigkeyid] = (
-                    uidrowid,
-                    pub_keyid_rowid_map[sigkeyid][0],
-                    fields[5],
-                    fields[6],
-                    sigtype
-                )
-    if uidsigs:
-        # store all sigs seen for previous key+uid
-        c.executemany(sigquery, uidsigs.values())
-        sigcount += len(uidsigs)
+            else:
+                sig_rows.append(row)
+                sigcount += 1
+        if sig_rows:
+            batches.put(sig_rows)
+    finally:
+        batches.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
 
     logger.info('Loaded %s valid sigs (%s ignored)' % (sigcount, ignored_sigs))
 
@@ -218,13 +298,32 @@ if __name__ == '__main__':
     except OSError as ex:
         pass
 
-    dbconn = sqlite3.connect(cmdargs.dbfile)
+    # We handle the transaction ourselves, so the whole load goes in at once.
+    # Sigs are inserted from a writer thread while the main one is parsing.
+    dbconn = sqlite3.connect(cmdargs.dbfile, isolation_level=None, check_same_thread=False)
     cursor = dbconn.cursor()
-    wotmate.init_sqlite_db(cursor)
-
-    (pub_map, uid_map) = keyring_load_pub_uid(cursor, cmdargs.use_weak)
-    keyring_load_sig_data(cursor, pub_map, uid_map)
+    # We're making a brand new file that's no good to anyone until we're
+    # done with it, so don't bother journaling, syncing or sharing it while
+    # loading it. None of these settings stick around after we close it.
+    cursor.executescript('''PRAGMA journal_mode=OFF;
+                            PRAGMA synchronous=OFF;
+                            PRAGMA locking_mode=EXCLUSIVE;
+                            PRAGMA temp_store=MEMORY;
+                            PRAGMA cache_size=-200000;
+                         ''')
+    try:
+        cursor.execute('BEGIN')
+        wotmate.init_sqlite_db(cursor)
+        (pub_map, uid_map) = keyring_load_pub_uid(cursor, cmdargs.use_weak)
+        keyring_load_sig_data(cursor, pub_map, uid_map)
+        cursor.execute('COMMIT')
+        wotmate.index_sqlite_db(cursor)
+    except BaseException:
+        # Without a journal there's nothing to roll back to, so don't
+        # leave a half-loaded db behind
+        dbconn.close()
+        os.unlink(cmdargs.dbfile)
+        raise
 
-    dbconn.commit()
     dbconn.close()
     logger.info('Wrote %s' % cmdargs.dbfile)
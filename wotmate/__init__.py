@@ -5,13 +5,23 @@
 __author__ = 'Konstantin Ryabitsev <konstantin@linuxfoundation.org>'
 
 import sys
+import re
+import pathlib
+import sqlite3
 import subprocess
 import logging
+import hashlib
+import base64
+import binascii
+import collections
+import queue
+import threading
+
+from array import array
 
 from typing import Optional
 
 from datetime import datetime
-import pydotplus.graphviz as pd
 
 
 ALGOS = {
@@ -25,6 +35,18 @@ ALGOS = {
 DB_VERSION = 1
 GPGBIN = '/usr/bin/gpg'
 GNUPGHOME = None
+# how much gpg output to read at a time when listing the keyring, and
+# how many of those reads to keep waiting while we're busy parsing
+GPG_READ_SIZE = 1048576
+GPG_READ_AHEAD = 64
+
+# Anything that isn't a plain DOT identifier or number gets quoted
+DOT_ID_RE = re.compile(r'^(?:[_a-zA-Z][a-zA-Z0-9_]*|[0-9]+)$')
+DOT_KEYWORDS = {'graph', 'subgraph', 'digraph', 'node', 'edge', 'strict'}
+DOT_ESCAPES = str.maketrans({'"': '\\"', '\n': '\\n', '\r': '\\r'})
+# Key nodes always have the same attributes, so we only have to fill them in
+GRAPH_NODE_FMT = 'a_%s [color=%s, label=%s, shape=record, style=rounded];'
+TRUST_COLORS = {'u': 'purple', 'f': 'red', 'm': 'blue'}
 
 logger = logging.getLogger(__name__)
 
@@ -32,31 +54,114 @@ logger = logging.getLogger(__name__)
 _all_signed_by_cache = dict()
 _all_sigs_cache = dict()
 _all_uiddata_cache = dict()
-_seenkeys = set()
+_graph_node_cache = dict()
+# in-memory signature graph, see load_sig_graph()
+_sig_graph = None
+
+# queries used in hot loops, kept in one place so they always hit
+# sqlite3's statement cache
+UIDDATA_BY_PUBROW_SQL = 'SELECT uiddata FROM uid WHERE pubrowid=?'
+ALL_UIDDATA_BY_PUBROW_SQL = 'SELECT uiddata FROM uid WHERE pubrowid=? ORDER BY rowid'
+ALL_SIGNED_BY_SQL = '''SELECT DISTINCT uid.pubrowid
+                        FROM uid JOIN sig ON sig.uidrowid = uid.rowid
+                       WHERE sig.pubrowid=?'''
+ALL_SIGNED_SQL = '''SELECT DISTINCT sig.pubrowid
+                     FROM sig JOIN uid ON sig.uidrowid = uid.rowid
+                    WHERE uid.pubrowid = ?'''
+GRAPH_NODE_SQL = '''SELECT pub.*,
+                          uid.uiddata
+                     FROM uid JOIN pub
+                       ON uid.pubrowid = pub.rowid
+                    WHERE pub.rowid=? AND uid.is_primary = 1'''
+GRAPH_NODES_SQL = '''SELECT pub.rowid,
+                           pub.*,
+                           uid.uiddata
+                      FROM uid JOIN pub
+                        ON uid.pubrowid = pub.rowid
+                     WHERE pub.rowid IN (%s) AND uid.is_primary = 1'''
+TRAIL_REACH_TABLE_SQL = '''CREATE TEMP TABLE IF NOT EXISTS trail_reach (
+                               rowid INTEGER PRIMARY KEY,
+                               dist INTEGER
+                           )'''
+TRAIL_REACH_SQL = '''INSERT INTO temp.trail_reach
+                     WITH RECURSIVE r(rowid, depth) AS (
+                         SELECT :to, 0
+                         UNION
+                         SELECT sig.pubrowid,
+                                r.depth + 1
+                           FROM r JOIN uid ON uid.pubrowid = r.rowid
+                                  JOIN sig ON sig.uidrowid = uid.rowid
+                          WHERE r.depth < :maxdepth
+                     )
+                     SELECT rowid, MIN(depth) FROM r GROUP BY rowid'''
+SIG_EDGES_SQL = '''SELECT DISTINCT sig.pubrowid, uid.pubrowid
+                   FROM sig JOIN uid ON sig.uidrowid = uid.rowid
+               ORDER BY sig.pubrowid, uid.pubrowid'''
+KEY_TRAILS_SQL = '''WITH RECURSIVE path(rowid, depth, trail) AS (
+                        SELECT :from, 0, ',' || :from || ','
+                        UNION
+                        SELECT uid.pubrowid,
+                               path.depth + 1,
+                               path.trail || uid.pubrowid || ','
+                          FROM path JOIN sig ON sig.pubrowid = path.rowid
+                                    JOIN uid ON uid.rowid = sig.uidrowid
+                                    JOIN temp.trail_reach AS reach ON reach.rowid = uid.pubrowid
+                         WHERE path.depth + 1 + reach.dist <= :maxdepth
+                           AND path.rowid != :to
+                           AND instr(path.trail, ',' || uid.pubrowid || ',') = 0
+                           AND (uid.pubrowid = :to OR instr(:ignore, ',' || uid.pubrowid || ',') = 0)
+                    )
+                    SELECT trail FROM path WHERE rowid = :to'''
 
 
 def get_uiddata_by_pubrow(c, p_rowid):
     if p_rowid not in _all_uiddata_cache:
-        c.execute('SELECT uiddata FROM uid WHERE pubrowid=?', (p_rowid,))
+        c.execute(UIDDATA_BY_PUBROW_SQL, (p_rowid,))
         _all_uiddata_cache[p_rowid] = c.fetchone()[0]
     return _all_uiddata_cache[p_rowid]
 
 
+def get_all_uiddata_by_pubrow(c, p_rowid):
+    c.execute(ALL_UIDDATA_BY_PUBROW_SQL, (p_rowid,))
+    return [row[0] for row in c.fetchall()]
+
+
+def get_all_primary_uids(c):
+    # Grab keyids and primary uids for all keys in one go, and warm up the
+    # uiddata cache while we're at it
+    c.execute('''SELECT pub.rowid,
+                        pub.keyid,
+                        uid.uiddata
+                   FROM uid JOIN pub
+                     ON uid.pubrowid = pub.rowid
+                  WHERE uid.is_primary = 1''')
+    keymeta = dict()
+    for (p_rowid, kid, uiddata) in c:
+        keymeta[p_rowid] = (kid, uiddata)
+        _all_uiddata_cache[p_rowid] = uiddata
+
+    return keymeta
+
+
 def get_logger(quiet=False):
-    logger.setLevel(logging.DEBUG)
+    # Set the level on the logger and not just on the handler, so that
+    # logger.isEnabledFor() tells us when a message would be thrown away
+    if quiet:
+        level = logging.CRITICAL
+    else:
+        level = logging.INFO
+    logger.setLevel(level)
     ch = logging.StreamHandler()
     formatter = logging.Formatter('%(message)s')
     ch.setFormatter(formatter)
-    if quiet:
-        ch.setLevel(logging.CRITICAL)
-    else:
-        ch.setLevel(logging.INFO)
+    ch.setLevel(level)
 
     logger.addHandler(ch)
     return logger
 
 
-def gpg_run_command(args: list, with_colons: bool = True, stdin: Optional[bytes] = None) -> bytes:
+def gpg_run_command(args: list, with_colons: bool = True, stdin: Optional[bytes] = None,
+                    strip: bool = True) -> bytes:
     cmdargs = [GPGBIN, '--batch']
     if with_colons:
         cmdargs += ['--with-colons']
@@ -66,11 +171,12 @@ def gpg_run_command(args: list, with_colons: bool = True, stdin: Optional[bytes]
     if GNUPGHOME is not None:
         env = {'GNUPGHOME': GNUPGHOME}
 
-    logger.debug('Running %s...' % ' '.join(cmdargs))
+    logger.debug('Running %s...', ' '.join(cmdargs))
 
     sp = subprocess.Popen(cmdargs, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
     (output, error) = sp.communicate(input=stdin)
-    output = output.strip()
+    if strip:
+        output = output.strip()
 
     if len(error.strip()):
         sys.stderr.buffer.write(error)
@@ -78,22 +184,214 @@ def gpg_run_command(args: list, with_colons: bool = True, stdin: Optional[bytes]
     return output
 
 
-def gpg_get_lines(args, matchonly=()):
-    output = gpg_run_command(args)
-    lines = []
-    logger.debug('Processing the output...')
-    for line in output.split(b'\n'):
-        if line == b'' or line[0] == b'#':
-            continue
-        if len(matchonly):
-            for match in matchonly:
-                if line.startswith(match):
-                    lines.append(line)
-                    continue
+def gpg_get_key_exports(kids: list, export_options: str) -> dict:
+    # Export many keys with a single gpg invocation and split the result
+    # into individual keys. We export binary here, because gpg wraps all
+    # keys into a single armored block when asked for armored output.
+    args = ['--export', '--export-options', export_options] + kids
+    output = gpg_run_command(args, with_colons=False, strip=False)
+    return openpgp_split_keys(output)
+
+
+def openpgp_keyid(body: bytes) -> Optional[str]:
+    # Work out the key id from the body of a public key packet
+    version = body[:1]
+    if version == b'\x04':
+        fpr = hashlib.sha1(b'\x99' + len(body).to_bytes(2, 'big') + body).digest()
+        return fpr[-8:].hex().upper()
+    if version in (b'\x05', b'\x06'):
+        # v5 and v6 fingerprints are sha256, and the key id is their start
+        prefix = b'\x9a' if version == b'\x05' else b'\x9b'
+        fpr = hashlib.sha256(prefix + len(body).to_bytes(4, 'big') + body).digest()
+        return fpr[:8].hex().upper()
+    if version in (b'\x02', b'\x03') and len(body) > 10:
+        # v3 (RSA only) key ids are the low 64 bits of the modulus, which
+        # is the first MPI after the creation time, expiry and algo
+        bits = int.from_bytes(body[8:10], 'big')
+        return body[10:10+(bits+7)//8][-8:].hex().upper()
+    return None
+
+
+def openpgp_split_keys(data: bytes) -> dict:
+    # Each exported key starts with a public key packet (tag 6), so
+    # walk the packet headers and cut the data at those boundaries.
+    keys = dict()
+    keyid = start = None
+    pos = 0
+    while pos < len(data):
+        ctb = data[pos]
+        if not ctb & 0x80:
+            logger.debug('Invalid packet header at offset %s', pos)
+            break
+        if ctb & 0x40:
+            # new format packet
+            tag = ctb & 0x3f
+            olen = data[pos+1]
+            if olen < 192:
+                hlen, plen = 2, olen
+            elif olen < 224:
+                hlen, plen = 3, ((olen - 192) << 8) + data[pos+2] + 192
+            elif olen == 255:
+                hlen, plen = 6, int.from_bytes(data[pos+2:pos+6], 'big')
+            else:
+                # partial body lengths are not used in exported keys
+                logger.debug('Unexpected partial length packet at offset %s', pos)
+                break
         else:
-            lines.append(line)
+            # old format packet
+            tag = (ctb >> 2) & 0x0f
+            ltype = ctb & 0x03
+            if ltype == 3:
+                logger.debug('Unexpected indeterminate length packet at offset %s', pos)
+                break
+            hlen = 1 + (1 << ltype)
+            plen = int.from_bytes(data[pos+1:pos+hlen], 'big')
+
+        if tag == 6:
+            if keyid is not None:
+                keys[keyid] = data[start:pos]
+            start = pos
+            body = data[pos+hlen:pos+hlen+plen]
+            keyid = openpgp_keyid(body)
+            if keyid is None:
+                logger.info('Skipping v%s key at offset %s, we don\'t know how to get its key id',
+                            body[:1].hex(), pos)
+        pos += hlen + plen
+
+    if keyid is not None:
+        keys[keyid] = data[start:pos]
+
+    return keys
+
+
+def make_crc24_table():
+    table = list()
+    for i in range(256):
+        crc = i << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864cfb
+        table.append(crc & 0xffffff)
+    return tuple(table)
+
+
+# lookup table for openpgp_crc24(), one entry per byte value
+CRC24_TABLE = make_crc24_table()
+
+
+def openpgp_crc24(data: bytes) -> int:
+    # The armor checksum, see RFC 4880, section 6.1
+    crc = 0xb704ce
+    for byte in data:
+        crc = ((crc << 8) & 0xffffff) ^ CRC24_TABLE[(crc >> 16) ^ byte]
+    return crc
+
+
+def openpgp_armor(data: bytes, blocktype: str = 'PUBLIC KEY BLOCK') -> bytes:
+    # Armor binary OpenPGP data the same way gpg -a does, so we don't have
+    # to run gpg again for data we've already exported
+    b64 = base64.b64encode(data)
+    lines = [b'-----BEGIN PGP %s-----' % blocktype.encode(), b'']
+    lines.extend(b64[i:i+64] for i in range(0, len(b64), 64))
+    lines.append(b'=' + base64.b64encode(openpgp_crc24(data).to_bytes(3, 'big')))
+    lines.append(b'-----END PGP %s-----' % blocktype.encode())
+    return b'\n'.join(lines)
+
+
+def openpgp_dearmor(data: bytes) -> Optional[bytes]:
+    # Return the binary contents of the first armored block found in data.
+    # This only slices out the armored block, so data can also be an mmap.
+    start = data.find(b'-----BEGIN PGP ')
+    if start < 0:
+        return None
+    end = data.find(b'-----END PGP ', start)
+    if end < 0:
+        end = len(data)
+    chunks = []
+    inbody = False
+    for line in data[start:end].split(b'\n')[1:]:
+        line = line.strip()
+        if not inbody:
+            # armor headers end with an empty line
+            if not line:
+                inbody = True
+            continue
+        if line.startswith(b'=') or line.startswith(b'-----'):
+            break
+        chunks.append(line)
+    try:
+        return base64.b64decode(b''.join(chunks))
+    except binascii.Error:
+        return None
+
+
+def gpg_read_chunks(fh, chunks):
+    # Runs in its own thread and hands out gpg output as it arrives, with
+    # an empty chunk at the end
+    try:
+        while True:
+            chunk = fh.read(GPG_READ_SIZE)
+            if not chunk:
+                break
+            chunks.put(chunk)
+    finally:
+        chunks.put(b'')
+
 
-    return lines
+def gpg_get_lines(args, matchonly=()):
+    # Hand out lines while gpg is still listing, instead of collecting its
+    # whole output first. We read in large chunks and split each of them
+    # in one go, carrying over the partial line at the end.
+    cmdargs = [GPGBIN, '--batch', '--with-colons'] + args
+    env = None
+    if GNUPGHOME is not None:
+        env = {'GNUPGHOME': GNUPGHOME}
+
+    logger.debug('Running %s...', ' '.join(cmdargs))
+    matchonly = tuple(matchonly)
+    linere = None
+    if matchonly:
+        linere = re.compile(b'^(?:%s).*$' % b'|'.join(re.escape(m) for m in matchonly), re.M)
+    # gpg's complaints go straight to our stderr
+    sp = subprocess.Popen(cmdargs, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL, env=env)
+    # Read from gpg in a separate thread, so it can keep going while we're
+    # parsing what it already gave us. Reading from the pipe releases the
+    # GIL, so the two don't get in each other's way.
+    chunks = queue.Queue(maxsize=GPG_READ_AHEAD)
+    reader = threading.Thread(target=gpg_read_chunks, args=(sp.stdout, chunks), daemon=True)
+    reader.start()
+    chunk = None
+    try:
+        tail = b''
+        while True:
+            chunk = chunks.get()
+            if not chunk:
+                break
+            if linere is not None:
+                # let the regex engine pick out the lines we want, so we
+                # don't loop over the ones we don't in python
+                chunk = tail + chunk
+                end = chunk.rfind(b'\n') + 1
+                tail = chunk[end:]
+                yield from linere.findall(chunk, 0, end)
+                continue
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                if line and not line.startswith(b'#'):
+                    yield line
+        if tail and not tail.startswith(b'#') and (not matchonly or tail.startswith(matchonly)):
+            yield tail
+    finally:
+        if chunk:
+            # we're bailing out early, so stop gpg and let the reader finish
+            sp.kill()
+            while chunk:
+                chunk = chunks.get()
+        reader.join()
+        sp.stdout.close()
+        sp.wait()
 
 
 def gpg_get_fields(bline):
@@ -109,6 +407,14 @@ def gpg_get_fields(bline):
     return fields
 
 
+def open_db_ro(dbfile):
+    # We never write to the db, so open it read-only and skip the locking
+    # and journal checks that come with being able to write. Going through
+    # as_uri() keeps '#', '?' and '%' in the path from being read as URI syntax.
+    dburi = pathlib.Path(dbfile).absolute().as_uri() + '?mode=ro'
+    return sqlite3.connect(dburi, uri=True, cached_statements=1024)
+
+
 def init_sqlite_db(c):
     # Create primary keys table
     logger.info('Initializing new sqlite3 db with metadata version %s' % DB_VERSION)
@@ -146,22 +452,33 @@ def init_sqlite_db(c):
                  ) WITHOUT ROWID''')
 
 
+def index_sqlite_db(c):
+    # Meant to be run once the tables are loaded, so we don't pay for
+    # index upkeep on every insert. The sig primary key already covers
+    # lookups by signed uid and pub.keyid is UNIQUE, so we only need the
+    # signer direction, uid-by-pub lookups and finding trusted keys.
+    logger.info('Indexing sqlite3 db')
+    c.executescript('''CREATE INDEX IF NOT EXISTS sig_signer_idx ON sig(pubrowid, uidrowid);
+                       CREATE INDEX IF NOT EXISTS uid_pubrow_primary_idx ON uid(pubrowid, is_primary);
+                       CREATE INDEX IF NOT EXISTS pub_ownertrust_idx ON pub(ownertrust);
+                       ANALYZE;
+                    ''')
+
+
 def get_all_signed_by(c, p_rowid):
+    # Returns a tuple of rowids of keys signed by p_rowid
     if p_rowid not in _all_signed_by_cache:
-        c.execute('''SELECT DISTINCT uid.pubrowid
-                                FROM uid JOIN sig ON sig.uidrowid = uid.rowid 
-                               WHERE sig.pubrowid=?''', (p_rowid,))
-        _all_signed_by_cache[p_rowid] = c.fetchall()
+        c.execute(ALL_SIGNED_BY_SQL, (p_rowid,))
+        _all_signed_by_cache[p_rowid] = tuple(row[0] for row in c)
 
     return _all_signed_by_cache[p_rowid]
 
 
 def get_all_signed(c, p_rowid):
+    # Returns a tuple of rowids of keys that signed p_rowid
     if p_rowid not in _all_sigs_cache:
-        c.execute('''SELECT DISTINCT sig.pubrowid 
-                       FROM sig JOIN uid ON sig.uidrowid = uid.rowid 
-                      WHERE uid.pubrowid = ?''', (p_rowid,))
-        _all_sigs_cache[p_rowid] = c.fetchall()
+        c.execute(ALL_SIGNED_SQL, (p_rowid,))
+        _all_sigs_cache[p_rowid] = tuple(row[0] for row in c)
 
     return _all_sigs_cache[p_rowid]
 
@@ -173,147 +490,327 @@ def get_all_full_trust(c):
     return c.fetchall()
 
 
+def dot_quote(value):
+    value = str(value)
+    if DOT_ID_RE.match(value) and value.lower() not in DOT_KEYWORDS:
+        return value
+    return '"%s"' % value.translate(DOT_ESCAPES)
+
+
+def cache_graph_node(p_rowid, show_trust, row):
+    # The same keys show up in a lot of graphs, so only work out
+    # what their nodes look like once
+    (color, label) = get_graph_node_label(row, show_trust)
+    _graph_node_cache[(p_rowid, show_trust)] = GRAPH_NODE_FMT % (p_rowid, color, dot_quote(label))
+
+
+def prefetch_graph_nodes(c, p_rowids, show_trust):
+    # Look up all keys we don't have nodes for yet with one query,
+    # instead of one query per key
+    missing = [p_rowid for p_rowid in p_rowids if (p_rowid, show_trust) not in _graph_node_cache]
+    # stay well under sqlite's limit on the number of query parameters
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i+500]
+        c.execute(GRAPH_NODES_SQL % ','.join('?' * len(chunk)), chunk)
+        for row in c:
+            if (row[0], show_trust) not in _graph_node_cache:
+                cache_graph_node(row[0], show_trust, row[1:])
+
+
 def make_graph_node(c, p_rowid, show_trust=False):
-    c.execute('''SELECT pub.*, 
-                        uid.uiddata
-                   FROM uid JOIN pub 
-                     ON uid.pubrowid = pub.rowid 
-                  WHERE pub.rowid=? AND uid.is_primary = 1''', (p_rowid,))
-    (kid, val, size, algo, cre, exp, trust, uiddata) = c.fetchone()
-
-    nodename = 'a_%s' % p_rowid
-    anode = pd.Node(nodename)
-    anode.set('shape', 'record')
-    anode.set('style', 'rounded')
-    if trust == 'u':
-        anode.set('color', 'purple')
-    elif trust == 'f':
-        anode.set('color', 'red')
-    elif trust == 'm':
-        anode.set('color', 'blue')
-    else:
-        anode.set('color', 'gray')
+    cachekey = (p_rowid, show_trust)
+    if cachekey not in _graph_node_cache:
+        c.execute(GRAPH_NODE_SQL, (p_rowid,))
+        cache_graph_node(p_rowid, show_trust, c.fetchone())
+
+    return _graph_node_cache[cachekey]
+
+
+def get_graph_node_label(row, show_trust):
+    (kid, val, size, algo, cre, exp, trust, uiddata) = row
 
     uiddata = uiddata.replace('"', '')
-    name = uiddata.split('<')[0].replace('"', '').strip()
-    name = name.split('(')[0].strip()
+    (name, bracket, email) = uiddata.partition('<')
+    name = name.partition('(')[0].strip()
 
-    try:
-        email = uiddata.split('<')[1].replace('>', '').strip()
-        try:
-            domain = email.split('@')[1]
-            show = domain
-        except IndexError:
-            show = email
-    except IndexError:
+    if bracket:
+        email = email.partition('<')[0].replace('>', '').strip()
+        (user, at, domain) = email.partition('@')
+        show = domain.partition('@')[0] if at else email
+    else:
         show = ''
 
-    if algo in ALGOS.keys():
+    if algo in ALGOS:
         keyline = '{%s %s|%s}' % (ALGOS[algo], size, kid)
     else:
         keyline = '{%s}' % kid
 
     if show_trust:
-        anode.set('label', '{{%s\n%s|{val: %s|tru: %s}}|%s}' % (name, show, val, trust, keyline))
+        label = '{{%s\n%s|{val: %s|tru: %s}}|%s}' % (name, show, val, trust, keyline)
     else:
-        anode.set('label', '{%s\n%s|%s}' % (name, show, keyline))
-    return anode
+        label = '{%s\n%s|%s}' % (name, show, keyline)
+    return TRUST_COLORS.get(trust, 'gray'), label
 
 
 def cull_redundant_paths(paths, maxpaths=None):
     paths.sort(key=len)
 
+    # All paths end at the same key, so a longer path shares a tail with a
+    # shorter one exactly when they share the last hop. That means we only
+    # need to remember the last hops we've already seen.
     culled = []
-    chunks = []
+    lasthops = set()
     for path in paths:
-        redundant = False
-        pos = -2
-        while pos > -len(path):
-            if path[pos:] in chunks:
-                redundant = True
-                break
-            chunks.append(path[pos:])
-            pos -= 1
+        if len(path) > 2:
+            lasthop = (path[-2], path[-1])
+            if lasthop in lasthops:
+                continue
+            lasthops.add(lasthop)
 
-        if not redundant:
-            culled.append(path)
-            if maxpaths and len(culled) >= maxpaths:
-                break
+        culled.append(path)
+        if maxpaths and len(culled) >= maxpaths:
+            break
 
     return culled
 
 
-def get_shortest_path(c, t_p_rowid, b_p_rowid, depth, maxdepth, ignorekeys):
-    global _seenkeys
-    # Zero out seenkeys at 0-depth
-    if depth == 0:
-        _seenkeys = set()
-    depth += 1
-    sigs = get_all_signed_by(c, t_p_rowid)
-
-    if (b_p_rowid,) in sigs:
-        return [t_p_rowid, b_p_rowid]
-
-    shortest = None
-
-    if depth >= maxdepth:
-        return None
-
-    for (s_p_rowid,) in sigs:
-        if s_p_rowid in ignorekeys or (depth, s_p_rowid) in _seenkeys:
+def make_csr(edges, size):
+    # Pack (from, to) pairs sorted by "from" into compressed sparse rows:
+    # the neighbours of n are indices[indptr[n]:indptr[n+1]]
+    indptr = array('l', bytes(array('l').itemsize * (size + 1)))
+    indices = array('l')
+    for (src, dst) in edges:
+        indptr[src+1] += 1
+        indices.append(dst)
+    for i in range(1, size + 1):
+        indptr[i] += indptr[i-1]
+
+    return indptr, indices
+
+
+def load_sig_graph(c):
+    # Tools that look up a lot of paths can load the whole signature graph
+    # into memory once, instead of asking sqlite to walk it for every lookup.
+    global _sig_graph
+    c.execute('SELECT MAX(rowid) FROM pub')
+    size = (c.fetchone()[0] or 0) + 1
+    c.execute(SIG_EDGES_SQL)
+    edges = c.fetchall()
+    signed = make_csr(edges, size)
+    edges.sort(key=lambda edge: edge[1])
+    signers = make_csr([(dst, src) for (src, dst) in edges], size)
+    _sig_graph = (size, signed, signers)
+    logger.debug('Loaded %s signatures between %s keys', len(edges), size - 1)
+
+
+def have_sig_graph():
+    return _sig_graph is not None
+
+
+def get_graph_trails(t_p_rowid, b_p_rowid, maxdepth, ignorekeys=()):
+    # Same as the sqlite walk in get_key_trails, but over the in-memory graph
+    size, (s_indptr, s_indices), (r_indptr, r_indices) = _sig_graph
+    if not 0 < t_p_rowid < size or not 0 < b_p_rowid < size:
+        return
+
+    # How many hops away from the bottom key is each key, one byte per key
+    # indexed by rowid, which is a lot cheaper to fill and check than a dict.
+    # Keys we can't reach within maxdepth stay at maxdepth + 1. Nobody has
+    # trails anywhere near 255 hops long, so we cap it to fit in a byte.
+    maxdepth = min(maxdepth, 254)
+    dist = bytearray([maxdepth + 1]) * size
+    dist[b_p_rowid] = 0
+    frontier = [b_p_rowid]
+    for depth in range(1, maxdepth + 1):
+        nextfrontier = list()
+        for p_rowid in frontier:
+            for signer in r_indices[r_indptr[p_rowid]:r_indptr[p_rowid+1]]:
+                if dist[signer] > depth:
+                    dist[signer] = depth
+                    nextfrontier.append(signer)
+        frontier = nextfrontier
+    if dist[t_p_rowid] > maxdepth:
+        return
+
+    ignore = set(ignorekeys)
+    trails = collections.deque([(t_p_rowid,)])
+    while trails:
+        trail = trails.popleft()
+        p_rowid = trail[-1]
+        if p_rowid == b_p_rowid:
+            yield list(trail)
             continue
-
-        subchain = get_shortest_path(c, s_p_rowid, b_p_rowid, depth, maxdepth, ignorekeys)
-        if subchain:
-            if shortest is None or len(shortest) > len(subchain):
-                shortest = subchain
-                _seenkeys.add((depth, s_p_rowid))
-                # no need to go any deeper than current shortest
-                maxdepth = depth - 1 + len(shortest)
+        for signed in s_indices[s_indptr[p_rowid]:s_indptr[p_rowid+1]]:
+            if len(trail) + dist[signed] > maxdepth:
+                continue
+            if signed in trail or (signed != b_p_rowid and signed in ignore):
+                continue
+            trails.append(trail + (signed,))
+
+
+def get_graph_shortest_path(t_p_rowid, b_p_rowid, maxdepth, ignorekeys=frozenset()):
+    # When we only need the shortest path, we don't need to carry trails.
+    # Search from both ends at once, taking turns between the top and the
+    # bottom side, and stop as soon as the two meet: that way we only go
+    # about half as deep from each side. Taking strict turns rather than
+    # growing whichever frontier is smaller means which of several equally
+    # short paths we return doesn't hinge on how many keys got ignored.
+    # We check ignorekeys for every key we see, so it should be a set.
+    size, (s_indptr, s_indices), (r_indptr, r_indices) = _sig_graph
+    if not 0 < t_p_rowid < size or not 0 < b_p_rowid < size:
+        return None
+    if t_p_rowid == b_p_rowid:
+        return [t_p_rowid]
+
+    # who we came from on the way down from the top key, and on the way up
+    # from the bottom key
+    t_parents = {t_p_rowid: None}
+    b_parents = {b_p_rowid: None}
+    t_frontier = [t_p_rowid]
+    b_frontier = [b_p_rowid]
+    meet = None
+    for depth in range(maxdepth):
+        if depth % 2 == 0:
+            (parents, others, frontier) = (t_parents, b_parents, t_frontier)
+            (indptr, indices) = (s_indptr, s_indices)
         else:
-            # if it returns with None, then this key is a dead-end at this and lower depths
-            for _d in range(depth, maxdepth):
-                _seenkeys.add((_d, s_p_rowid))
-
-    if shortest is not None:
-        _seenkeys.add((depth, t_p_rowid))
-        return [t_p_rowid] + shortest
+            (parents, others, frontier) = (b_parents, t_parents, b_frontier)
+            (indptr, indices) = (r_indptr, r_indices)
 
-    return None
+        nextfrontier = list()
+        for p_rowid in frontier:
+            for n_rowid in indices[indptr[p_rowid]:indptr[p_rowid+1]]:
+                if n_rowid in parents:
+                    continue
+                if n_rowid in others:
+                    # the other side's keys are never in ignorekeys, unless
+                    # it's the key they started from
+                    parents[n_rowid] = p_rowid
+                    meet = n_rowid
+                    break
+                if n_rowid in ignorekeys:
+                    continue
+                parents[n_rowid] = p_rowid
+                nextfrontier.append(n_rowid)
+            if meet is not None:
+                break
+        if meet is not None:
+            break
+        if not nextfrontier:
+            return None
+        if parents is t_parents:
+            t_frontier = nextfrontier
+        else:
+            b_frontier = nextfrontier
 
+    if meet is None:
+        return None
 
-def draw_key_paths(c, paths, graph, show_trust):
-    seenactors = {}
+    path = list()
+    p_rowid = meet
+    while p_rowid is not None:
+        path.append(p_rowid)
+        p_rowid = t_parents[p_rowid]
+    path.reverse()
+    p_rowid = b_parents[meet]
+    while p_rowid is not None:
+        path.append(p_rowid)
+        p_rowid = b_parents[p_rowid]
+
+    return path
+
+
+def get_key_trails(c, t_p_rowid, b_p_rowid, maxdepth, ignorekeys=()):
+    if _sig_graph is not None:
+        yield from get_graph_trails(t_p_rowid, b_p_rowid, maxdepth, ignorekeys)
+        return
+
+    # Walk the signature graph breadth-first inside sqlite, carrying the trail
+    # of visited rowids as a comma-padded string, so we can catch cycles with
+    # instr(). Keys in ignorekeys are never used as intermediate hops.
+    ignore = ',%s,' % ','.join(str(x) for x in ignorekeys)
+    # use a separate cursor, as callers may need theirs while we iterate
+    cur = c.connection.cursor()
+    # Walk backwards from the bottom key first to find out how many hops away
+    # from it each key is, so we never follow a branch that can't get there
+    # within maxdepth. If the top key isn't in there, we're done.
+    cur.execute(TRAIL_REACH_TABLE_SQL)
+    cur.execute('DELETE FROM temp.trail_reach')
+    cur.execute(TRAIL_REACH_SQL,
+                {'to': b_p_rowid, 'maxdepth': maxdepth})
+    cur.execute('SELECT dist FROM temp.trail_reach WHERE rowid = ?', (t_p_rowid,))
+    if cur.fetchone() is None:
+        return
+
+    cur.execute(KEY_TRAILS_SQL,
+                {'from': t_p_rowid, 'to': b_p_rowid, 'maxdepth': maxdepth, 'ignore': ignore})
+
+    # rows come out of the recursion in the order of depth, so shortest first
+    for (trail,) in cur:
+        yield [int(x) for x in trail.strip(',').split(',')]
+
+
+def get_shortest_path(c, t_p_rowid, b_p_rowid, maxdepth, ignorekeys=()):
+    if _sig_graph is not None:
+        return get_graph_shortest_path(t_p_rowid, b_p_rowid, maxdepth, frozenset(ignorekeys))
+
+    return next(get_key_trails(c, t_p_rowid, b_p_rowid, maxdepth, ignorekeys), None)
+
+
+def draw_key_paths(c, paths, font, fontsize, show_trust):
+    # We write DOT source ourselves, as it's just text and a lot cheaper
+    # than building an object tree only to have it turned into text.
+    lines = ['digraph G {', 'node [fontname=%s, fontsize=%s];' % (dot_quote(font), dot_quote(fontsize))]
+    prefetch_graph_nodes(c, {actor for path in paths for actor in path}, show_trust)
     # make a subgraph for toplevel nodes
-    tl_subgraph = pd.Subgraph('cluster_toplevel')
-    tl_subgraph.set('color', 'white')
+    toplevel = ['subgraph cluster_toplevel {', 'color=white;']
+    seenactors = set()
+    # paths can share their first few hops, so only draw each edge once
+    seenedges = set()
     for path in paths:
         signer = None
         for actor in path:
-            if actor not in seenactors.keys():
-                anode = make_graph_node(c, actor, show_trust)
-                seenactors[actor] = anode
+            if actor not in seenactors:
+                seenactors.add(actor)
                 if signer is None:
-                    tl_subgraph.add_node(anode)
+                    toplevel.append(make_graph_node(c, actor, show_trust))
                 else:
-                    graph.add_node(anode)
-            else:
-                anode = seenactors[actor]
+                    lines.append(make_graph_node(c, actor, show_trust))
+
+            if signer is not None and (signer, actor) not in seenedges:
+                seenedges.add((signer, actor))
+                lines.append('a_%s -> a_%s;' % (signer, actor))
+
+            signer = actor
+
+    toplevel.append('}')
+    lines.extend(toplevel)
+    lines.extend(('', '}', ''))
+    return '\n'.join(lines)
 
-            if signer is not None:
-                graph.add_edge(pd.Edge(signer, anode))
 
-            signer = anode
+def write_graph(dotsrc, outfile, outformat):
+    args = ['dot', '-T%s' % outformat, '-o', outfile]
+    sp = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (output, error) = sp.communicate(input=dotsrc.encode())
+    if sp.returncode:
+        logger.critical('dot exited with %s: %s', sp.returncode, error.decode(errors='replace').strip())
+        return False
 
-    graph.add_subgraph(tl_subgraph)
+    return True
 
 
 def get_pubrow_id(c, whatnot):
     # first, attempt to treat it as key id
     try:
         int(whatnot, 16)
-        as_keyid = '%%%s' % whatnot[-16:].upper()
-        c.execute('''SELECT DISTINCT rowid FROM pub WHERE keyid LIKE ?''', (as_keyid,))
+        keyid = whatnot[-16:].upper()
+        if len(keyid) == 16:
+            # a full keyid or fingerprint, so we can use the keyid index
+            # instead of matching the tail of every keyid we have
+            c.execute('''SELECT rowid FROM pub WHERE keyid = ?''', (keyid,))
+        else:
+            c.execute('''SELECT DISTINCT rowid FROM pub WHERE keyid LIKE ?''', ('%%%s' % keyid,))
         rows = c.fetchall()
         if len(rows) == 1:
             return rows[0][0]
@@ -340,40 +837,49 @@ def get_pubrow_id(c, whatnot):
 
 
 def get_key_paths(c, t_p_rowid, b_p_rowid, maxdepth=5, maxpaths=5):
-    # Next, get rowids of all keys signed by top key
-    sigs = get_all_signed_by(c, t_p_rowid)
-    if not sigs:
+    if not get_all_signed_by(c, t_p_rowid):
         logger.critical('Top key did not sign any keys')
         sys.exit(1)
 
-    ignorekeys = [item for sublist in sigs for item in sublist] + [t_p_rowid]
-
-    if b_p_rowid in ignorekeys:
-        logger.debug('Bottom key is signed directly by the top key')
+    if t_p_rowid == b_p_rowid:
+        # The path searches would give us just [t_p_rowid], but we've
+        # always treated a key as a direct hop away from itself
         return [[t_p_rowid, b_p_rowid]]
 
-    logger.debug('Found %s keys signed by top key' % len(sigs))
-    lookedat = 0
-
     paths = []
-
-    for (s_p_rowid,) in sigs:
-        lookedat += 1
-        # logger.debug('Trying "%s" (%s/%s)', get_uiddata_by_pubrow(c, s_p_rowid), lookedat, len(sigs))
-        path = get_shortest_path(c, s_p_rowid, b_p_rowid, 0, maxdepth-1, ignorekeys)
-        if path:
-            logger.debug('`- found a path with %s members' % len(path))
-            paths.append([t_p_rowid] + path)
-            if len(path) > 2:
-                ignorekeys += path[1:-2]
+    lastedges = set()
+
+    if maxpaths == 1:
+        # A single path is just the shortest one, which we can find a lot
+        # quicker than by listing trails
+        path = get_shortest_path(c, t_p_rowid, b_p_rowid, maxdepth)
+        if path is not None:
+            logger.debug('Only needed one path, using the shortest')
+            return [path]
+        trails = ()
+    else:
+        trails = get_key_trails(c, t_p_rowid, b_p_rowid, maxdepth)
+
+    for path in trails:
+        if len(path) == 2:
+            logger.debug('Bottom key is signed directly by the top key')
+            return [path]
+        paths.append(path)
+        # Paths arrive shortest-first, so once we have enough of them ending
+        # in distinct signatures, culling won't pick anything that follows.
+        lastedges.add(tuple(path[-2:]))
+        if maxpaths and len(lastedges) >= maxpaths:
+            break
 
     if not paths:
-        logger.info('No valid paths between %s and %s',
-                    get_uiddata_by_pubrow(c, t_p_rowid), get_uiddata_by_pubrow(c, b_p_rowid))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('No valid paths between %s and %s',
+                        get_uiddata_by_pubrow(c, t_p_rowid), get_uiddata_by_pubrow(c, b_p_rowid))
         return []
 
+    logger.debug('Found %s candidate paths', len(paths))
     culled = cull_redundant_paths(paths, maxpaths)
-    logger.debug('%s paths left after culling' % len(culled))
+    logger.debug('%s paths left after culling', len(culled))
 
     return culled
 
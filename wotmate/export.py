@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright © 2018-2024 by The Linux Foundation and contributors
+__author__ = 'Konstantin Ryabitsev <konstantin@linuxfoundation.org>'
+
+import sys
+import os
+import pathlib
+import subprocess
+import logging
+import logging.handlers
+import multiprocessing
+import collections
+import functools
+import hashlib
+import mmap
+
+from concurrent.futures import ProcessPoolExecutor
+
+from email.utils import parseaddr
+from urllib.parse import quote_plus
+
+import wotmate
+
+
+# how many keys to hand to each worker at once
+BATCH_SIZE = 50
+
+# per-worker state, set up by init_worker
+cmdargs = None
+logger = None
+c = None
+from_rowid = None
+keydir = None
+graphdir = None
+existing_keys = None
+
+
+def init_worker(wcmdargs, wfrom_rowid, wkeydir, wgraphdir, wexisting_keys, logq, loglevel):
+    global cmdargs, logger, c, from_rowid, keydir, graphdir, existing_keys
+    cmdargs = wcmdargs
+    from_rowid = wfrom_rowid
+    keydir = wkeydir
+    graphdir = wgraphdir
+    existing_keys = wexisting_keys
+
+    if cmdargs.gnupghome:
+        wotmate.GNUPGHOME = cmdargs.gnupghome
+    if cmdargs.gpgbin:
+        wotmate.GPGBIN = cmdargs.gpgbin
+
+    # send all log records to the parent, so output lines don't get mangled,
+    # but don't bother with the ones the parent is going to drop anyway
+    logger = wotmate.logger
+    logger.setLevel(loglevel)
+    logger.handlers = [logging.handlers.QueueHandler(logq)]
+
+    # each worker gets its own read-only connection
+    dbconn = wotmate.open_db_ro(cmdargs.dbfile)
+    c = dbconn.cursor()
+    # Forked workers already have the signature graph the parent loaded,
+    # but spawned ones (the default on macOS, and forkserver on Linux
+    # since python 3.14) start out without it
+    if not wotmate.have_sig_graph():
+        wotmate.load_sig_graph(c)
+
+
+def get_key_headers(kids):
+    # gpg separates listings of multiple keys with an empty line, and the
+    # first line after "pub" is the fingerprint, which ends with the keyid
+    args = ['--list-options', 'show-notations', '--list-options',
+            'no-show-uid-validity', '--with-subkey-fingerprints', '--list-key'] + kids
+    output = wotmate.gpg_run_command(args, with_colons=False)
+    headers = dict()
+    for block in output.split(b'\n\n'):
+        lines = block.strip().split(b'\n')
+        if len(lines) < 2:
+            continue
+        kid = lines[1].strip()[-16:].decode()
+        headers[kid] = block.strip()
+
+    return headers
+
+
+def export_keys(batch):
+    # Export the whole batch in one go to find out which keys have changed
+    exports = wotmate.gpg_get_key_exports([kid for (to_rowid, kid) in batch], cmdargs.key_export_options)
+    changed = list()
+    for to_rowid, kid in batch:
+        keyout = os.path.join(keydir, '%s.asc' % kid)
+        digest = None
+        if kid in exports:
+            digest = hashlib.blake2b(exports[kid]).hexdigest()
+            if key_unchanged(keyout, exports[kid], digest):
+                logger.debug('No changes for %s', kid)
+                continue
+        # No point in talking to gpg about keys we're not going to export
+        key_paths = wotmate.get_key_paths(c, from_rowid, to_rowid, cmdargs.maxdepth, cmdargs.maxpaths)
+        if not len(key_paths):
+            logger.debug('Skipping %s due to invalid WoT', kid)
+            continue
+        changed.append((to_rowid, kid, key_paths, exports.get(kid), digest))
+
+    results = list()
+    if not changed:
+        return len(batch), results
+
+    headers = get_key_headers([kid for (to_rowid, kid, key_paths, keybin, digest) in changed])
+    graphs = dict()
+    for to_rowid, kid, key_paths, keybin, digest in changed:
+        keyout = os.path.join(keydir, '%s.asc' % kid)
+        graphs[kid] = export_key(kid, keyout, key_paths, headers.get(kid), keybin, digest)
+        results.append((to_rowid, kid, keyout))
+
+    render_graphs(graphs)
+
+    return len(batch), results
+
+
+def key_unchanged(keyout, keybin, digest):
+    # Do we already have a file in place?
+    if os.path.basename(keyout) not in existing_keys:
+        return False
+    # We keep the digest of the last export next to the .asc file, so we
+    # don't have to load and dearmor the whole thing to compare
+    if os.path.basename(keyout) + '.blake2b' in existing_keys:
+        with open(keyout + '.blake2b', 'r') as fin:
+            return fin.read().strip() == digest
+
+    # Exports made before we started writing digests. Map the file instead
+    # of reading it, as we only need the armored block past the header.
+    with open(keyout, 'rb') as fin:
+        try:
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if wotmate.openpgp_dearmor(mm) != keybin:
+                    return False
+        except ValueError:
+            # empty file
+            return False
+    write_digest(keyout, digest)
+    return True
+
+
+def write_digest(keyout, digest):
+    with open(keyout + '.blake2b', 'w') as fout:
+        fout.write(digest + '\n')
+
+
+def render_graphs(graphs):
+    if not graphs:
+        return
+    # Render the whole batch with a single dot run instead of one per key.
+    # With -O, dot writes each input file to <input>.<format>, so we name
+    # the sources after the keyid and get <kid>.<format> next to them.
+    srcpaths = list()
+    digests = dict()
+    for kid, dotsrc in graphs.items():
+        srcpath = os.path.join(graphdir, kid)
+        # Keys often change without their paths changing, so we keep a
+        # hash of the DOT source next to the graph and don't redraw it
+        # if it's the same
+        digest = hashlib.sha1(dotsrc.encode()).digest()
+        if graph_unchanged('%s.%s' % (srcpath, cmdargs.graph_out_format), digest):
+            logger.debug('No graph changes for %s', kid)
+            continue
+        with open(srcpath, 'w') as fout:
+            fout.write(dotsrc)
+        srcpaths.append(srcpath)
+        digests[srcpath] = digest
+
+    if not srcpaths:
+        return
+
+    try:
+        args = ['dot', '-T%s' % cmdargs.graph_out_format, '-O'] + srcpaths
+        sp = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (output, error) = sp.communicate()
+        if sp.returncode:
+            logger.critical('dot exited with %s: %s', sp.returncode, error.decode(errors='replace').strip())
+            return
+    finally:
+        for srcpath in srcpaths:
+            os.unlink(srcpath)
+
+    for srcpath in srcpaths:
+        graphout = '%s.%s' % (srcpath, cmdargs.graph_out_format)
+        with open(graphout + '.sha1', 'wb') as fout:
+            fout.write(digests[srcpath])
+        logger.info('Wrote %s', graphout)
+
+
+def graph_unchanged(graphout, digest):
+    try:
+        with open(graphout + '.sha1', 'rb') as fin:
+            if fin.read() != digest:
+                return False
+    except FileNotFoundError:
+        return False
+    return os.path.exists(graphout)
+
+
+def export_key(kid, keyout, key_paths, header=None, keybin=None, digest=None):
+    # Writes out the key and returns the DOT source of its graph
+    if keybin is not None:
+        # We already have the key from the batch export, so armor it
+        # ourselves instead of asking gpg to export it again
+        keydata = wotmate.openpgp_armor(keybin)
+    else:
+        args = ['-a', '--export', '--export-options', cmdargs.key_export_options, kid]
+        keydata = wotmate.gpg_run_command(args, with_colons=False)
+
+    if header is None:
+        args = ['--list-options', 'show-notations', '--list-options',
+                'no-show-uid-validity', '--with-subkey-fingerprints', '--list-key', kid]
+        header = wotmate.gpg_run_command(args, with_colons=False)
+
+    # Write the pieces out as they are, no need to glue them together first
+    with open(keyout, 'wb') as fout:
+        fout.writelines((header, b'\n\n', keydata, b'\n'))
+        logger.info('Wrote %s', keyout)
+    if digest is not None:
+        write_digest(keyout, digest)
+
+    return wotmate.draw_key_paths(c, key_paths, cmdargs.font, cmdargs.fontsize, cmdargs.show_trust)
+
+
+def get_batches(keymeta):
+    batch = list()
+    for to_rowid, (kid, uiddata) in keymeta.items():
+        batch.append((to_rowid, kid))
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def get_results(ex, batches, maxpending):
+    # Executor.map() submits everything up front, so keep only a bounded
+    # number of batches in flight and hand results back in order
+    pending = collections.deque()
+    for batch in batches:
+        pending.append(ex.submit(export_keys, batch))
+        if len(pending) >= maxpending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+@functools.lru_cache(maxsize=None)
+def get_uid_addr(uiddata):
+    # Returns (local, domain) for a uid, or None
+    parts = parseaddr(uiddata)
+    if not len(parts[1]) or parts[1].count('@') != 1:
+        return None
+    return tuple(parts[1].split('@', 1))
+
+
+def get_existing_symlinks(openpgpdir):
+    # Read the whole b4 keyring in one pass, so we don't have to poke at
+    # every symlink separately. Returns the dirs we found and a dict of
+    # symlink paths to their targets.
+    found_dirs = set()
+    symlinks = dict()
+    if not os.path.isdir(openpgpdir):
+        return found_dirs, symlinks
+    for dentry in os.scandir(openpgpdir):
+        if not dentry.is_dir(follow_symlinks=False):
+            continue
+        for lentry in os.scandir(dentry.path):
+            if not lentry.is_dir(follow_symlinks=False):
+                continue
+            found_dirs.add(lentry.path)
+            for sentry in os.scandir(lentry.path):
+                if sentry.name == 'default' and sentry.is_symlink():
+                    symlinks[sentry.path] = os.readlink(sentry.path)
+
+    return found_dirs, symlinks
+
+
+def make_b4_symlinks(kid, keyout, uids, my_symlinks, made_dirs, existing_symlinks):
+    for uiddata in uids:
+        addr = get_uid_addr(uiddata)
+        if addr is None:
+            continue
+        local, domain = addr
+        kpath = os.path.join(cmdargs.outdir, '.keyring', 'openpgp', quote_plus(domain), quote_plus(local))
+        if kpath not in made_dirs:
+            pathlib.Path(kpath).mkdir(parents=True, exist_ok=True)
+            made_dirs.add(kpath)
+        spath = os.path.join(kpath, 'default')
+        tpath = os.path.relpath(keyout, kpath)
+        if spath in existing_symlinks:
+            if existing_symlinks[spath] == tpath:
+                continue
+            if spath in my_symlinks:
+                # There's multiple keys with the same identity. First one wins, for the lack of a
+                # better solution that is also sane.
+                logger.info('Notice: multiple keys with the same UID %s@%s', local, domain)
+                continue
+            os.unlink(spath)
+            logger.info('Notice: fixing symlink for %s@%s', local, domain)
+        os.symlink(tpath, spath)
+        existing_symlinks[spath] = tpath
+        my_symlinks.add(spath)
+        logger.info('Symlinked %s to %s', kid, spath)
+
+
+def run(wcmdargs):
+    # Takes the argparse namespace export-keyring.py builds, so other tools
+    # can import wotmate.export and call this instead of shelling out
+    global cmdargs, logger
+    cmdargs = wcmdargs
+    logger = wotmate.logger
+
+    if cmdargs.gnupghome:
+        wotmate.GNUPGHOME = cmdargs.gnupghome
+    if cmdargs.gpgbin:
+        wotmate.GPGBIN = cmdargs.gpgbin
+
+    # The indexes we need are made by make-sqlitedb.
+    dbconn = wotmate.open_db_ro(cmdargs.dbfile)
+    c = dbconn.cursor()
+    # Keep the working set in memory
+    c.executescript('''PRAGMA temp_store=MEMORY;
+                       PRAGMA mmap_size=268435456;
+                       PRAGMA cache_size=-65536;
+                    ''')
+
+    if not cmdargs.fromkey:
+        from_rowid = wotmate.get_u_key(c)
+        if from_rowid is None:
+            logger.critical('Could not find ultimate-trust key, try specifying --fromkey')
+            sys.exit(1)
+    else:
+        from_rowid = wotmate.get_pubrow_id(c, cmdargs.fromkey)
+        if from_rowid is None:
+            sys.exit(1)
+
+    # Grab metadata for all keys in one query
+    keymeta = wotmate.get_all_primary_uids(c)
+    # We look up paths for every key, so walk them in memory instead of
+    # in sqlite. Forked workers inherit this, the rest load their own.
+    wotmate.load_sig_graph(c)
+
+    keydir = os.path.join(cmdargs.outdir, 'keys')
+    os.makedirs(keydir, exist_ok=True)
+    graphdir = os.path.join(cmdargs.outdir, 'graphs')
+    os.makedirs(graphdir, exist_ok=True)
+    # One directory read instead of a stat per key
+    existing_keys = frozenset(os.listdir(keydir))
+
+    kcount = wcount = 0
+    my_symlinks = set()
+    made_dirs = set()
+    existing_symlinks = dict()
+    if cmdargs.gen_b4_keyring:
+        made_dirs, existing_symlinks = get_existing_symlinks(os.path.join(cmdargs.outdir, '.keyring', 'openpgp'))
+    logq = multiprocessing.Queue()
+    loglistener = logging.handlers.QueueListener(logq, *logger.handlers, respect_handler_level=True)
+    loglistener.start()
+    with ProcessPoolExecutor(max_workers=cmdargs.jobs, initializer=init_worker,
+                             initargs=(cmdargs, from_rowid, keydir, graphdir, existing_keys, logq,
+                                       logger.getEffectiveLevel())) as ex:
+        for (bcount, results) in get_results(ex, get_batches(keymeta), cmdargs.jobs * 2):
+            kcount += bcount
+            for (to_rowid, kid, keyout) in results:
+                # Symlinks are made here and not in the workers, so we can sanely
+                # handle multiple keys with the same identity
+                if cmdargs.gen_b4_keyring:
+                    # We already have all valid uids in the db, no need to
+                    # parse them out of gpg's key listing
+                    uids = wotmate.get_all_uiddata_by_pubrow(c, to_rowid)
+                    make_b4_symlinks(kid, keyout, uids, my_symlinks, made_dirs, existing_symlinks)
+                wcount += 1
+
+    loglistener.stop()
+    logger.info('Processed %s keys, made %s changes', kcount, wcount)